@@ -7,6 +7,9 @@ from supabase_client import supabase  # your supabase client instance
 # from mlxtend.frequent_patterns import apriori, association_rules
 # from mlxtend.preprocessing import TransactionEncoder
 import time
+import heapq
+import threading
+import zlib
 from functools import lru_cache
 
 # ------------------ IMAGE MAPPING ------------------
@@ -61,11 +64,13 @@ def _normalize_accommodation(df):
         "name": df.get("Project/Owner Name", ""),
         "category": "accommodation",
         "area": df.get("Locality / Area", df.get("City", "")),
+        "city": df.get("City", ""),
         "rating": _num(df.get("Rating", np.nan)).fillna(0).clip(0, 5),
         "price": _num(df.get("Rent Price", np.nan)).fillna(0)
     })
     
     out["area"] = _clean_area(out["area"])
+    out["city"] = _clean_area(out["city"])
     out["price"] = out["price"].astype(float)
     
     # Keep only rows that have valid service_ids  
@@ -79,11 +84,13 @@ def _normalize_food(df):
         "name": df.get("restaurant_name", ""),
         "category": "food",
         "area": df.get("city", df.get("location", "")),
+        "city": df.get("city", ""),
         "rating": _num(df.get("rating", np.nan)).fillna(0).clip(0, 5),
         "price": _num(df.get("price", np.nan)).fillna(0)
     })
     
     out["area"] = _clean_area(out["area"])
+    out["city"] = _clean_area(out["city"])
     out["price"] = out["price"].astype(float)
     
     # Keep only rows that have valid service_ids
@@ -98,11 +105,13 @@ def _normalize_tiffin(df):
         "name": df.get("Name", ""),
         "category": "tiffin",
         "area": df.get("City", df.get("city", "")),
+        "city": df.get("City", df.get("city", "")),
         "rating": _num(df.get("Rating", np.nan)).fillna(0).clip(0, 5),
         "price": _num(price_series).fillna(0)
     })
     
     out["area"] = _clean_area(out["area"])
+    out["city"] = _clean_area(out["city"])
     out["price"] = out["price"].astype(float)
     
     # Keep only rows that have valid service_ids
@@ -114,6 +123,139 @@ food_df = _normalize_food(food_raw)
 tiffin_df = _normalize_tiffin(tiffin_raw)
 service_df = pd.concat([accommodation_df, food_df, tiffin_df], ignore_index=True)
 
+def _location_key(value) -> str:
+    return str(value or "").strip().lower()
+
+# service_id -> row position in service_df, and service_id -> (city, area, category).
+# Built once so lookups by id don't scan the whole catalog.
+_service_rows = {}
+_service_locations = {}
+for _pos, (_sid, _city, _area, _category) in enumerate(zip(
+        service_df["service_id"], service_df["city"], service_df["area"], service_df["category"])):
+    if _sid in _service_rows:
+        continue
+    _service_rows[_sid] = _pos
+    _service_locations[_sid] = (_location_key(_city), _location_key(_area), _location_key(_category))
+
+# ------------------ POPULARITY LEADERBOARDS ------------------
+# Leaderboards are keyed by (location, category); "" in either slot means "all".
+# A location is either the service's city or its area/locality.
+LEADERBOARD_SIZE = 50
+_LEADERBOARD_TTL = 300  # 5 minutes before /popular re-syncs from Supabase
+
+_bookmark_counts = {}     # service_id -> number of wishlist rows
+_partition_members = {}   # partition key -> service_ids with a non-zero count
+_leaderboards = {}        # partition key -> [(count, service_id)], best first, at most LEADERBOARD_SIZE
+_leaderboards_timestamp = None
+
+# Flask serves requests on several threads. Writers hold this lock; boards are
+# never mutated in place, only replaced, so get_leaderboard reads without it.
+_leaderboard_lock = threading.Lock()
+
+def _rank(entry):
+    count, service_id = entry
+    return (-count, str(service_id))
+
+def _service_partitions(service_id):
+    """All leaderboard keys a service contributes to (empty if not in the catalog)"""
+    if service_id not in _service_locations:
+        return []
+    city, area, category = _service_locations[service_id]
+    locations = {"", city, area}
+    return [(loc, cat) for loc in locations for cat in ("", category)]
+
+def _top_k(service_ids, counts):
+    return heapq.nsmallest(
+        LEADERBOARD_SIZE,
+        ((counts[sid], sid) for sid in service_ids),
+        key=_rank
+    )
+
+def _apply_to_partition(key, service_id, old_count, new_count):
+    members = _partition_members.setdefault(key, set())
+    board = _leaderboards.get(key, [])
+    if new_count > 0:
+        members.add(service_id)
+    else:
+        members.discard(service_id)
+
+    on_board = any(sid == service_id for _, sid in board)
+    kept = len(board) if new_count > 0 else len(board) - 1
+    if on_board and new_count < old_count and len(members) > kept:
+        # A service below the cut may now outrank it, rebuild from the partition
+        _leaderboards[key] = _top_k(members, _bookmark_counts)
+        return
+
+    entries = [(c, sid) for c, sid in board if sid != service_id]
+    if new_count > 0:
+        entries.append((new_count, service_id))
+    entries.sort(key=_rank)
+    _leaderboards[key] = entries[:LEADERBOARD_SIZE]
+
+def update_bookmark_count(service_id, delta: int):
+    """Incrementally apply a bookmark add (+1) or removal (-1) to the leaderboards"""
+    with _leaderboard_lock:
+        _update_bookmark_count(service_id, delta)
+
+def _update_bookmark_count(service_id, delta: int):
+    old_count = _bookmark_counts.get(service_id, 0)
+    new_count = max(old_count + delta, 0)
+    if new_count == old_count:
+        return
+    if new_count > 0:
+        _bookmark_counts[service_id] = new_count
+    else:
+        _bookmark_counts.pop(service_id, None)
+    for key in _service_partitions(service_id):
+        _apply_to_partition(key, service_id, old_count, new_count)
+
+def _wishlist_counts(wishlist_df: pd.DataFrame) -> dict:
+    if wishlist_df.empty or "service_id" not in wishlist_df.columns:
+        return {}
+    return wishlist_df["service_id"].value_counts().to_dict()
+
+def build_leaderboards(wishlist_df: pd.DataFrame):
+    """Join wishlist counts to the service catalog and build every leaderboard from scratch"""
+    with _leaderboard_lock:
+        _build_leaderboards(wishlist_df)
+
+def _build_leaderboards(wishlist_df: pd.DataFrame):
+    global _bookmark_counts, _partition_members, _leaderboards, _leaderboards_timestamp
+    counts = _wishlist_counts(wishlist_df)
+    members = {}
+    for service_id in counts:
+        for key in _service_partitions(service_id):
+            members.setdefault(key, set()).add(service_id)
+    boards = {key: _top_k(service_ids, counts) for key, service_ids in members.items()}
+
+    # Swap the new state in whole so readers never see a half-built board
+    _bookmark_counts, _partition_members, _leaderboards = counts, members, boards
+    _leaderboards_timestamp = time.time()
+    print(f"🏆 Built {len(boards)} popularity leaderboards from {len(counts)} services")
+
+def sync_leaderboards(wishlist_df: pd.DataFrame):
+    """Bring the leaderboards in line with the wishlist, touching only services whose count changed"""
+    global _leaderboards_timestamp
+    new_counts = _wishlist_counts(wishlist_df)
+    with _leaderboard_lock:
+        if _leaderboards_timestamp is None:
+            _build_leaderboards(wishlist_df)
+            return
+
+        for service_id in set(_bookmark_counts) | set(new_counts):
+            delta = new_counts.get(service_id, 0) - _bookmark_counts.get(service_id, 0)
+            if delta:
+                _update_bookmark_count(service_id, delta)
+        _leaderboards_timestamp = time.time()
+
+def leaderboards_stale() -> bool:
+    return _leaderboards_timestamp is None or time.time() - _leaderboards_timestamp > _LEADERBOARD_TTL
+
+def get_leaderboard(area: str = "", category: str = "", k: int = 10):
+    """Top-k (service_id, bookmark_count) pairs for an area/city and category"""
+    board = _leaderboards.get((_location_key(area), _location_key(category)), [])
+    return [(service_id, count) for count, service_id in board[:max(k, 0)]]
+
 # ------------------ FETCH WISHLIST ------------------
 def fetch_wishlist() -> pd.DataFrame:
     """Fetch wishlist table from Supabase"""
@@ -132,127 +274,235 @@ def get_association_recommendations(user_id: str, wishlist_df: pd.DataFrame, rul
     ...
 """
 
+# ------------------ RECOMMENDATION PIPELINE ------------------
+# Each stage is a generator function taking the request context and lazily
+# yielding (service_id, score) candidates, best first. The merger stops pulling
+# as soon as top_k usable ids are collected, so later stages often never run.
+# Stage priority is list order: local popularity > popularity > random.
+# Each stage also has a format_block(block, score) that decides which block
+# fields its score fills; every block records its stage under "source".
+RECOMMENDATION_STAGES = []  # [(name, generate, time_budget_seconds, format_block)]
+
+# name -> running totals, see get_stage_stats()
+_stage_stats = {}
+
+def _popularity_fields(block, score):
+    block["popularity_score"] = int(score)
+    block["bookmarked_by_users"] = int(score)
+
+def _fallback_fields(block, score):
+    block["popularity_score"] = 0
+    block["bookmarked_by_users"] = 0
+
+def register_stage(name: str, generate, time_budget: float = 0.05, position: int = None,
+                   format_block=_popularity_fields):
+    """Add a candidate generation stage to the pipeline (appended unless position is given)"""
+    stage = (name, generate, time_budget, format_block)
+    if position is None:
+        RECOMMENDATION_STAGES.append(stage)
+    else:
+        RECOMMENDATION_STAGES.insert(position, stage)
+
+def _local_popularity_stage(context):
+    """Popular services in the user's city (given, or inferred from their bookmarks)"""
+    area = context["area"] or _infer_user_area(context["bookmarks"])
+    if not area:
+        return
+    for service_id, bookmark_count in get_leaderboard(area, "", LEADERBOARD_SIZE):
+        yield service_id, bookmark_count
+
+def _popularity_stage(context):
+    # Bookmarked services are skipped by the merger, so the remaining counts
+    # are exactly the other users' bookmark counts.
+    for service_id, bookmark_count in get_leaderboard("", "", LEADERBOARD_SIZE):
+        yield service_id, bookmark_count
+
+# Catalog ids for the random fallback, built once
+_catalog_ids = list(_service_rows)
+
+def _random_stage(context):
+    # Draw lazily; the merger drops repeats. Seeded per user so a user's
+    # fallback picks stay stable between requests but differ across users.
+    rng = np.random.default_rng(zlib.crc32(str(context["user_id"]).encode()))
+    for _ in range(len(_catalog_ids)):
+        yield _catalog_ids[rng.integers(len(_catalog_ids))], 0
+
+# register_stage("association_rules", _association_rules_stage)  # commented out with the rules above
+register_stage("local_popularity", _local_popularity_stage)
+register_stage("popularity", _popularity_stage)
+register_stage("random", _random_stage, time_budget=0.1, format_block=_fallback_fields)
+
+def _stage_entry(name: str):
+    return _stage_stats.setdefault(name, {
+        "runs": 0, "skipped": 0, "yielded": 0, "accepted": 0,
+        "short_circuits": 0, "budget_exceeded": 0, "total_time": 0.0
+    })
+
+def _record_stage(name: str, yielded: int, accepted: int, elapsed: float, short_circuit: bool, over_budget: bool):
+    stats = _stage_entry(name)
+    stats["runs"] += 1
+    stats["yielded"] += yielded
+    stats["accepted"] += accepted
+    stats["short_circuits"] += int(short_circuit)
+    stats["budget_exceeded"] += int(over_budget)
+    stats["total_time"] += elapsed
+
+def _merge_stages(context, top_k: int, stages):
+    """Pull candidates stage by stage until top_k unique, non-bookmarked ids are collected"""
+    seen = set(context["bookmarks"])
+    winners = []  # [(service_id, score, stage name)]
+
+    for name, generate, time_budget, _ in stages:
+        if len(winners) >= top_k:
+            # Already full, the stage is never started
+            _stage_entry(name)["skipped"] += 1
+            continue
+
+        start = time.perf_counter()
+        yielded = accepted = 0
+        short_circuit = over_budget = False
+        candidates = iter(generate(context))
+        try:
+            for service_id, score in candidates:
+                yielded += 1
+                if service_id not in seen and service_id in _service_rows:
+                    seen.add(service_id)
+                    winners.append((service_id, score, name))
+                    accepted += 1
+                if len(winners) >= top_k:
+                    short_circuit = True
+                    break
+                if time.perf_counter() - start > time_budget:
+                    over_budget = True
+                    break
+        finally:
+            if hasattr(candidates, "close"):
+                candidates.close()
+
+        elapsed = time.perf_counter() - start
+        _record_stage(name, yielded, accepted, elapsed, short_circuit, over_budget)
+        print(f"⏱️ Stage {name}: {accepted}/{yielded} candidates accepted in {elapsed * 1000:.1f}ms"
+              + (" (over budget)" if over_budget else ""))
+
+    return winners
+
+def get_stage_stats():
+    """Per-stage totals: runs, skipped runs, candidates yielded/accepted, short-circuits, budget overruns and time"""
+    return {name: dict(stats) for name, stats in _stage_stats.items()}
+
 # ------------------ HYBRID RECOMMENDATION ------------------
-def recommend_for_user(user_id: str, wishlist_df: pd.DataFrame, top_k: int = 5):
-    """Hybrid recommendations: Popularity-based + Random fallback (Association rules commented out)"""
+def recommend_for_user(user_id: str, wishlist_df: pd.DataFrame, top_k: int = 5, area: str = None, stages=None):
+    """Hybrid recommendations from the stage pipeline: Local popularity + Popularity-based + Random fallback"""
     user_rows = wishlist_df[wishlist_df["user_id"] == user_id]
     user_bookmarks = set(user_rows["service_id"].tolist())
 
     print(f"\n🔍 Generating recommendations for user: {user_id}")
     print(f"User has {len(user_bookmarks)} bookmarks")
 
-    recommendations = []
-
-    # 1. Association rules recommendation commented out
-    # print("\n📊 Generating association rules...")
-    # rules_df = generate_association_rules(wishlist_df, min_support=0.02, min_confidence=0.1)
-    # if not rules_df.empty and user_bookmarks:
-    #     association_recs = get_association_recommendations(user_id, wishlist_df, rules_df, top_k)
-    #     recommendations.extend(association_recs)
+    sync_leaderboards(wishlist_df)
+    context = {
+        "user_id": user_id,
+        "wishlist_df": wishlist_df,
+        "bookmarks": user_bookmarks,
+        "area": area,
+        "top_k": top_k
+    }
+    stages = RECOMMENDATION_STAGES if stages is None else stages
+    winners = _merge_stages(context, top_k, stages)
+    return _scored_blocks(winners, {name: format_block for name, _, _, format_block in stages})
+
+def _infer_user_area(user_bookmarks: set) -> str:
+    """Most common city among the services a user has bookmarked"""
+    cities = {}
+    for service_id in user_bookmarks:
+        if service_id in _service_locations:
+            city = _service_locations[service_id][0]
+            if city:
+                cities[city] = cities.get(city, 0) + 1
+    if not cities:
+        return ""
+    return max(cities, key=cities.get)
+
+def _scored_blocks(scored_ids, formatters):
+    """Render (service_id, score, source) triples in one batch, letting each source's formatter fill its fields"""
+    blocks = _services_to_blocks([service_id for service_id, _, _ in scored_ids])
+    out = []
+    for service_id, score, source in scored_ids:
+        block = blocks.get(service_id)
+        if block is None:
+            continue
+        block["source"] = source
+        formatters[source](block, score)
+        out.append(block)
+    return out
 
-    # 2. Fill remaining slots with popularity-based recommendations
-    remaining_slots = top_k - len(recommendations)
-    if remaining_slots > 0:
-        print(f"📈 Getting {remaining_slots} popularity-based recommendations...")
-        popularity_recs = get_popularity_recommendations(user_id, wishlist_df, remaining_slots)
-        
-        already_recommended = set(r["id"] for r in recommendations)
-        filtered_popularity = [r for r in popularity_recs if r["id"] not in already_recommended]
-        recommendations.extend(filtered_popularity[:remaining_slots])
-
-    # 3. Fill any remaining slots with random recommendations
-    remaining_slots = top_k - len(recommendations)
-    if remaining_slots > 0:
-        print(f"🎲 Getting {remaining_slots} random recommendations...")
-        already_ids = set(r["id"] for r in recommendations) | user_bookmarks
-        random_recs = _random_recs(already_ids, remaining_slots)
-        recommendations.extend(random_recs)
-
-    # Sort by recommendation type priority: popularity > random
-    def get_priority(rec):
-        if rec.get('bookmarked_by_users', 0) > 0:
-            return (1, rec.get('bookmarked_by_users', 0))
-        else:
-            return (2, 0)
-    recommendations.sort(key=get_priority)
-    return recommendations[:top_k]
+def _leaderboard_recs(area: str, category: str, exclude_ids: set, n: int):
+    """Render the top n leaderboard entries for a partition, skipping excluded ids"""
+    if n <= 0:
+        return []
+    picked = []
+    for service_id, bookmark_count in get_leaderboard(area, category, LEADERBOARD_SIZE):
+        if service_id in exclude_ids or service_id not in _service_rows:
+            continue
+        picked.append((service_id, bookmark_count, "popularity"))
+        if len(picked) >= n:
+            break
+    return _scored_blocks(picked, {"popularity": _popularity_fields})
 
-def get_popularity_recommendations(user_id: str, wishlist_df: pd.DataFrame, top_k: int = 5):
-    """Get popularity-based recommendations"""
+def get_popularity_recommendations(user_id: str, wishlist_df: pd.DataFrame, top_k: int = 5, area: str = ""):
+    """Get popularity-based recommendations, optionally limited to an area/city"""
     user_rows = wishlist_df[wishlist_df["user_id"] == user_id]
     user_bookmarks = set(user_rows["service_id"].tolist())
 
-    other_users_data = wishlist_df[wishlist_df["user_id"] != user_id]
-    
-    if other_users_data.empty:
-        return []
-
-    service_popularity = other_users_data["service_id"].value_counts()
-    popular_services = service_popularity[~service_popularity.index.isin(user_bookmarks)]
-    
-    if popular_services.empty:
-        return []
+    # Services the user already bookmarked are excluded, so the remaining
+    # counts are exactly the other users' bookmark counts.
+    sync_leaderboards(wishlist_df)
+    return _leaderboard_recs(area, "", user_bookmarks, top_k)
 
-    recommendations = []
-    for service_id, bookmark_count in popular_services.head(top_k * 2).items():
-        rec = _service_to_block(service_id)
-        if rec:
-            rec["popularity_score"] = int(bookmark_count)
-            rec["bookmarked_by_users"] = int(bookmark_count)
-            recommendations.append(rec)
-        if len(recommendations) >= top_k:
-            break
+def get_popular_services(area: str = "", category: str = "", k: int = 10):
+    """Most bookmarked services for an area/city and category, read from the leaderboards"""
+    return _leaderboard_recs(area, category, set(), k)
 
-    return recommendations
-
-def _service_to_block(service_id: str):
-    """Find service by real service_id across all DataFrames"""
-    row = service_df[service_df["service_id"] == service_id]
-    if row.empty:
-        return None
-    s = row.iloc[0]
-    category = s.get("category", "")
+def _services_to_blocks(service_ids):
+    """Render service blocks keyed by service_id with a single row lookup (unknown ids are left out)"""
+    positions = [_service_rows[sid] for sid in service_ids if sid in _service_rows]
+    if not positions:
+        return {}
+    rows = service_df.iloc[positions][["service_id", "name", "category", "area", "rating", "price"]]
     return {
-        "id": s["service_id"],
-        "name": s.get("name", ""),
-        "category": category,
-        "area": s.get("area", ""),
-        "rating": float(s.get("rating", 0.0)),
-        "price": str(s.get("price", 0.0)),
-        "image": _get_mock_image(category)  # Add mock image based on category
+        service_id: {
+            "id": service_id,
+            "name": name,
+            "category": category,
+            "area": area,
+            "rating": float(rating),
+            "price": str(price),
+            "image": _get_mock_image(category)  # Add mock image based on category
+        }
+        for service_id, name, category, area, rating, price in rows.itertuples(index=False, name=None)
     }
 
-def _random_recs(exclude_ids: set, n: int):
-    pool = service_df[~service_df["service_id"].isin(list(exclude_ids))]
-    if pool.empty or n <= 0:
-        return []
-    sample = pool.sample(min(n, len(pool)), random_state=42)
-    out = []
-    for _, s in sample.iterrows():
-        out.append({
-            "id": s["service_id"],
-            "name": s.get("name", ""),
-            "category": s.get("category", ""),
-            "area": s.get("area", ""),
-            "rating": float(s.get("rating", 0.0)),
-            "price": str(s.get("price", 0.0)),
-            "popularity_score": 0,
-            "bookmarked_by_users": 0
-        })
-    return out
+def _service_to_block(service_id: str):
+    """Find service by real service_id across all DataFrames"""
+    return _services_to_blocks([service_id]).get(service_id)
 
 def get_popularity_stats(wishlist_df: pd.DataFrame):
     """Get statistics about service popularity"""
     if wishlist_df.empty:
         return {}
-    
-    service_counts = wishlist_df["service_id"].value_counts()
+
+    sync_leaderboards(wishlist_df)
+    # Read the counts directly so ids missing from the catalog are still counted
+    with _leaderboard_lock:
+        unique_services = len(_bookmark_counts)
+        top_10 = [(service_id, count) for count, service_id in
+                  heapq.nsmallest(10, ((c, sid) for sid, c in _bookmark_counts.items()), key=_rank)]
     return {
         "total_bookmarks": len(wishlist_df),
-        "unique_services": len(service_counts),
-        "most_popular_service": service_counts.index[0] if len(service_counts) > 0 else None,
-        "max_bookmarks": service_counts.iloc[0] if len(service_counts) > 0 else 0,
-        "top_10_popular": service_counts.head(10).to_dict()
+        "unique_services": unique_services,
+        "most_popular_service": top_10[0][0] if top_10 else None,
+        "max_bookmarks": top_10[0][1] if top_10 else 0,
+        "top_10_popular": dict(top_10)
     }
 
 # ------------------ TEST ------------------
@@ -290,12 +540,18 @@ if __name__ == "__main__":
     recs = recommend_for_user(test_user_id, wishlist_df, top_k=5)
     for i, rec in enumerate(recs, 1):
         rec_type = ""
-        if rec.get('bookmarked_by_users', 0) > 0:
-            rec_type = f" (📈 Popular: {rec['bookmarked_by_users']} users)"
-        else:
+        if rec.get('source') == 'random':
             rec_type = " (🎲 Random fallback)"
+        elif rec.get('bookmarked_by_users', 0) > 0:
+            rec_type = f" (📈 Popular: {rec['bookmarked_by_users']} users, {rec['source']})"
+        else:
+            rec_type = f" ({rec.get('source', 'unknown')})"
         
         print(f"{i}. {rec['name']} - {rec['category']} - ⭐{rec['rating']} - ₹{rec['price']}{rec_type}")
     
+    print(f"\n⏱️ STAGE STATS:")
+    for name, stats in get_stage_stats().items():
+        print(f"  {name}: {stats}")
+
     print(f"\nFull JSON response:")
     print(json.dumps(recs, indent=2))
@@ -3,7 +3,7 @@ from flask_cors import CORS
 import pandas as pd
 import traceback
 from supabase_client import supabase
-from recommender import recommend_for_user
+from recommender import recommend_for_user, get_popular_services, sync_leaderboards, leaderboards_stale, LEADERBOARD_SIZE
 
 app = Flask(__name__)
 # Enable CORS for all routes and origins
@@ -74,8 +74,11 @@ def get_recommendations(user_id):
         # Get number of recommendations from query params, default 5
         n_recommendations = int(request.args.get("n", 5))
 
+        # Optional area/city to localise popularity, otherwise inferred from bookmarks
+        area = request.args.get("area")
+
         # Generate personalized recommendations
-        recommendations = recommend_for_user(user_id, wishlist_df, top_k=n_recommendations)
+        recommendations = recommend_for_user(user_id, wishlist_df, top_k=n_recommendations, area=area)
 
         return jsonify({
             "status": "success",
@@ -87,6 +90,37 @@ def get_recommendations(user_id):
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+@app.route("/popular", methods=["GET"])
+def get_popular():
+    """Most bookmarked services, optionally filtered by area/city and category"""
+    try:
+        area = request.args.get("area", "")
+        category = request.args.get("category", "")
+        # Leaderboards only keep the top LEADERBOARD_SIZE services per partition
+        k = min(int(request.args.get("k", 10)), LEADERBOARD_SIZE)
+
+        # Leaderboards are maintained in memory; only re-sync once they go stale
+        if leaderboards_stale():
+            if not supabase:
+                return jsonify({"status": "error", "message": "Supabase client not initialized"}), 500
+
+            result = supabase.table("wishlists").select("*").execute()
+            if hasattr(result, "error") and result.error:
+                raise Exception(f"Supabase select error: {result.error.message}")
+            sync_leaderboards(pd.DataFrame(result.data))
+
+        return jsonify({
+            "status": "success",
+            "area": area,
+            "category": category,
+            "k": k,
+            "popular": get_popular_services(area, category, k)
+        }), 200
+
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
 if __name__ == "__main__":
     print("Starting Flask server...")
     try: